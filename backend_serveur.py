@@ -1,36 +1,92 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
-import sqlite3
-from datetime import datetime
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from typing import Annotated, Any, List, Optional
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
+from functools import lru_cache
+import asyncio
+import logging
+import os
+import aiosqlite
+import orjson
+from aiosqlitepool import SQLiteConnectionPool
+from cachetools import TTLCache
 
-app = FastAPI(title="Edison Catalogue API")
+class ORJSONResponse(JSONResponse):
+    """Réponse JSON sérialisée en C par orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+logger = logging.getLogger(__name__)
+
+async def stop_task(task: asyncio.Task):
+    """Annuler une tâche de fond et attendre sa fin"""
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ouvrir la connexion d'écriture et le pool des lecteurs, réutilisés par toutes les requêtes,
+    puis tout fermer à l'arrêt (ou dès l'échec d'une étape du démarrage)
+    """
+    async with AsyncExitStack() as stack:
+        app.state.writer = await connect_db()
+        stack.push_async_callback(app.state.writer.close)
+        app.state.writer_lock = asyncio.Lock()
+        await init_db()
+        
+        app.state.readers = SQLiteConnectionPool(lambda: connect_db(read_only=True), pool_size=READERS_POOL_SIZE)
+        stack.push_async_callback(app.state.readers.close)
+        
+        app.state.watcher = await connect_db(read_only=True)
+        stack.push_async_callback(app.state.watcher.close)
+        app.state.watch_task = asyncio.create_task(watch_data_version())
+        stack.push_async_callback(stop_task, app.state.watch_task)
+        
+        yield
+
+app = FastAPI(title="Edison Catalogue API", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# CORS : origines autorisées via CORS_ORIGINS (séparées par des virgules)
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()]
 
-# CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials="*" not in CORS_ORIGINS,
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
+# Compression des réponses (listes de produits)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # ============================================================
 # MODELS
 # ============================================================
 
 class Product(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+    
     reference: str
     designation: str
-    price: float
+    price: Annotated[float, Field(ge=0)]
     unit: str = "U"
     family: str = "Divers"
     icon: str = "📦"
 
 class ProductUpdate(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+    
     designation: str
-    price: float
+    price: Annotated[float, Field(ge=0)]
     unit: str = "U"
     family: str = "Divers"
 
@@ -39,67 +95,228 @@ class ProductUpdate(BaseModel):
 # ============================================================
 
 DB_PATH = "catalogue.db"
+FETCH_CHUNK_SIZE = 1000
+READERS_POOL_SIZE = 8
+CACHED_STATEMENTS = 256
 
-def init_db():
-    """Initialiser la base de données"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            reference TEXT PRIMARY KEY,
-            designation TEXT NOT NULL,
-            price REAL NOT NULL,
-            unit TEXT DEFAULT 'U',
-            family TEXT DEFAULT 'Divers',
-            icon TEXT DEFAULT '📦',
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
+async def connect_db(read_only: bool = False):
+    """Ouvrir une connexion SQLite réglée (cache, mmap, timeout)"""
+    if read_only:
+        conn = await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True, iter_chunk_size=FETCH_CHUNK_SIZE, cached_statements=CACHED_STATEMENTS)
+    else:
+        conn = await aiosqlite.connect(DB_PATH, iter_chunk_size=FETCH_CHUNK_SIZE, cached_statements=CACHED_STATEMENTS)
+    await conn.executescript("""
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA cache_size = -65536;
+        PRAGMA busy_timeout = 5000;
     """)
+    return conn
+
+@asynccontextmanager
+async def db_reader():
+    """Emprunter une connexion en lecture seule au pool des lecteurs"""
+    async with app.state.readers.connection() as conn:
+        yield conn
+
+@asynccontextmanager
+async def db_writer():
+    """Obtenir l'unique connexion d'écriture (une écriture à la fois)"""
+    async with app.state.writer_lock:
+        try:
+            yield app.state.writer
+        except BaseException:
+            await app.state.writer.rollback()
+            raise
+
+SCHEMA_VERSION = 1
+
+SCHEMA_SQL = f"""
+    -- Mode WAL persistant dans le fichier : positionné une seule fois
+    PRAGMA journal_mode = WAL;
+    
+    BEGIN IMMEDIATE;
+    
+    CREATE TABLE IF NOT EXISTS products (
+        reference TEXT PRIMARY KEY,
+        designation TEXT NOT NULL,
+        price REAL NOT NULL,
+        unit TEXT DEFAULT 'U',
+        family TEXT DEFAULT 'Divers',
+        icon TEXT DEFAULT '📦',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_products_family ON products(family);
+    
+    -- Index plein texte pour la recherche, synchronisé par triggers
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+        USING fts5(reference, designation, content='products', content_rowid='rowid');
+    
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, reference, designation)
+        VALUES (new.rowid, new.reference, new.designation);
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, reference, designation)
+        VALUES ('delete', old.rowid, old.reference, old.designation);
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF reference, designation ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, reference, designation)
+        VALUES ('delete', old.rowid, old.reference, old.designation);
+        INSERT INTO products_fts(rowid, reference, designation)
+        VALUES (new.rowid, new.reference, new.designation);
+    END;
     
-    conn.commit()
-    conn.close()
+    -- Indexer les produits déjà présents (base antérieure à l'index plein texte)
+    INSERT INTO products_fts(products_fts) VALUES ('rebuild');
+    
+    PRAGMA user_version = {SCHEMA_VERSION};
+    
+    COMMIT;
+"""
+
+async def init_db():
+    """Initialiser la base de données (schéma versionné par PRAGMA user_version)"""
+    async with db_writer() as conn:
+        async with conn.execute("PRAGMA user_version") as cursor:
+            (version,) = await cursor.fetchone()
+        
+        # Schéma à jour : aucun DDL ni transaction d'écriture au démarrage
+        if version < SCHEMA_VERSION:
+            await conn.executescript(SCHEMA_SQL)
+
+PRODUCT_COLUMNS = ("reference", "designation", "price", "unit", "family", "icon")
+
+PRODUCTS_SELECT = "SELECT " + ", ".join(PRODUCT_COLUMNS) + " FROM products"
+PRODUCTS_FTS_FILTER = "rowid IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)"
+
+# Requêtes figées par combinaison de filtres (famille, recherche) :
+# chaînes SQL identiques d'une requête à l'autre => cache de statements SQLite
+PRODUCTS_QUERIES = {
+    (False, False): PRODUCTS_SELECT,
+    (True, False): PRODUCTS_SELECT + " WHERE family = ?",
+    (False, True): PRODUCTS_SELECT + " WHERE " + PRODUCTS_FTS_FILTER,
+    (True, True): PRODUCTS_SELECT + " WHERE family = ? AND " + PRODUCTS_FTS_FILTER,
+}
+
+# Écritures : chaînes SQL uniques réutilisées partout => statements préparés en cache
+SQL_INSERT_PRODUCT = """INSERT INTO products (reference, designation, price, unit, family, icon)
+    VALUES (?, ?, ?, ?, ?, ?)"""
 
-init_db()
+SQL_UPDATE_PRODUCT = """UPDATE products
+    SET designation = ?, price = ?, unit = ?, family = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE reference = ?"""
+
+SQL_DELETE_PRODUCT = "DELETE FROM products WHERE reference = ? RETURNING " + ", ".join(PRODUCT_COLUMNS)
+
+SQL_EXISTING_REFERENCES = """SELECT reference FROM products
+    WHERE reference IN (SELECT value FROM json_each(?))"""
+
+# UPSERT multi-lignes : au plus 999 paramètres par requête (SQLITE_LIMIT_VARIABLE_NUMBER
+# historique), soit 166 produits de 6 colonnes
+BATCH_ROWS_PER_STATEMENT = 999 // len(PRODUCT_COLUMNS)
+
+@lru_cache(maxsize=None)
+def upsert_products_sql(count: int) -> str:
+    """Requête UPSERT pour `count` produits (chaîne identique pour un même nombre)"""
+    return (
+        "INSERT INTO products (" + ", ".join(PRODUCT_COLUMNS) + ") VALUES "
+        + ", ".join(["(?, ?, ?, ?, ?, ?)"] * count)
+        + """
+    ON CONFLICT(reference) DO UPDATE SET
+        designation = excluded.designation, price = excluded.price,
+        unit = excluded.unit, family = excluded.family,
+        icon = excluded.icon, updated_at = CURRENT_TIMESTAMP"""
+    )
+
+# Corps JSON déjà sérialisés par filtre (famille, recherche), vidés à chaque écriture.
+# Cache propre à chaque worker : les écritures des autres workers sont détectées
+# via PRAGMA data_version toutes les CACHE_POLL_INTERVAL secondes.
+# Taille bornée en octets (somme des corps), les corps trop gros ne sont pas mis en cache.
+PRODUCTS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PRODUCTS_CACHE_MAX_BODY = 8 * 1024 * 1024
+PRODUCTS_CACHE = TTLCache(maxsize=PRODUCTS_CACHE_MAX_BYTES, ttl=60, getsizeof=len)
+CACHE_POLL_INTERVAL = 1.0
+
+# Incrémenté à chaque invalidation : une lecture commencée avant une écriture
+# ne doit pas remettre en cache un corps obsolète
+PRODUCTS_CACHE_GENERATION = 0
+
+def invalidate_products_cache():
+    """Vider PRODUCTS_CACHE et invalider les lectures en cours"""
+    global PRODUCTS_CACHE_GENERATION
+    PRODUCTS_CACHE_GENERATION += 1
+    PRODUCTS_CACHE.clear()
+
+async def watch_data_version():
+    """Vider PRODUCTS_CACHE dès qu'une autre connexion a modifié la base"""
+    last_version = None
+    while True:
+        try:
+            async with app.state.watcher.execute("PRAGMA data_version") as cursor:
+                (version,) = await cursor.fetchone()
+            if version != last_version:
+                invalidate_products_cache()
+                last_version = version
+        except Exception:
+            # Changements des autres workers invisibles : vider le cache par précaution
+            logger.exception("Lecture de PRAGMA data_version impossible")
+            invalidate_products_cache()
+        await asyncio.sleep(CACHE_POLL_INTERVAL)
+
+def fts_query(search: str) -> str:
+    """Transformer une saisie libre en requête FTS5 (préfixe sur chaque mot)"""
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in search.split())
 
 # ============================================================
 # ENDPOINTS
 # ============================================================
 
-@app.get("/health")
+@app.get("/health", response_model=None)
 async def health_check():
     """Health check endpoint"""
-    return {"status": "OK"}
+    return ORJSONResponse({"status": "OK"})
 
-@app.get("/api/products")
-async def get_products():
-    """Récupérer tous les produits"""
+@app.get("/api/products", response_model=None)
+async def get_products(family: Optional[str] = None, search: Optional[str] = None):
+    """Récupérer les produits, filtrés par famille et/ou recherche"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        search = search.strip() if search else None
+        cache_key = (family or None, search)
+        body = PRODUCTS_CACHE.get(cache_key)
         
-        cursor.execute("SELECT reference, designation, price, unit, family, icon FROM products")
-        rows = cursor.fetchall()
+        if body is None:
+            generation = PRODUCTS_CACHE_GENERATION
+            params = []
+            
+            if family:
+                params.append(family)
+            if search:
+                params.append(fts_query(search))
+            
+            sql = PRODUCTS_QUERIES[(bool(family), bool(search))]
+            
+            # Sérialisation paquet par paquet (fetchmany) : seuls FETCH_CHUNK_SIZE
+            # dictionnaires existent à la fois, le reste est déjà en octets JSON
+            chunks = []
+            count = 0
+            
+            async with db_reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    while rows := await cursor.fetchmany(FETCH_CHUNK_SIZE):
+                        chunks.append(orjson.dumps([dict(zip(PRODUCT_COLUMNS, row)) for row in rows])[1:-1])
+                        count += len(rows)
+            
+            body = b'{"success":true,"count":%d,"products":[%b]}' % (count, b",".join(chunks))
+            if generation == PRODUCTS_CACHE_GENERATION and len(body) <= PRODUCTS_CACHE_MAX_BODY:
+                PRODUCTS_CACHE[cache_key] = body
         
-        products = [
-            {
-                "reference": row[0],
-                "designation": row[1],
-                "price": row[2],
-                "unit": row[3],
-                "family": row[4],
-                "icon": row[5]
-            }
-            for row in rows
-        ]
-        
-        conn.close()
-        
-        return {
-            "success": True,
-            "products": products
-        }
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -107,24 +324,21 @@ async def get_products():
 async def create_product(product: Product):
     """Créer un nouveau produit"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT reference FROM products WHERE reference = ?", (product.reference,))
-        if cursor.fetchone():
-            conn.close()
-            raise HTTPException(status_code=400, detail="Cette référence existe déjà")
-        
-        cursor.execute(
-            """INSERT INTO products (reference, designation, price, unit, family, icon)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (product.reference, product.designation, product.price, product.unit, product.family, product.icon)
-        )
+        async with db_writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            
+            await conn.execute(
+                SQL_INSERT_PRODUCT,
+                (product.reference, product.designation, product.price, product.unit, product.family, product.icon)
+            )
+            
+            await conn.commit()
         
-        conn.commit()
-        conn.close()
+        invalidate_products_cache()
         
         return {"success": True, "message": "Produit créé"}
+    except aiosqlite.IntegrityError:
+        raise HTTPException(status_code=400, detail="Cette référence existe déjà")
     except HTTPException:
         raise
     except Exception as e:
@@ -134,24 +348,19 @@ async def create_product(product: Product):
 async def update_product(reference: str, product: ProductUpdate):
     """Mettre à jour un produit existant"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT reference FROM products WHERE reference = ?", (reference,))
-        if not cursor.fetchone():
-            conn.close()
-            raise HTTPException(status_code=404, detail="Produit non trouvé")
+        async with db_writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            
+            async with conn.execute(
+                SQL_UPDATE_PRODUCT,
+                (product.designation, product.price, product.unit, product.family, reference)
+            ) as cursor:
+                if cursor.rowcount == 0:
+                    raise HTTPException(status_code=404, detail="Produit non trouvé")
+            
+            await conn.commit()
         
-        cursor.execute(
-            """UPDATE products 
-               SET designation = ?, price = ?, unit = ?, family = ?, updated_at = ?
-               WHERE reference = ?""",
-            (product.designation, product.price, product.unit, product.family, 
-             datetime.now().isoformat(), reference)
-        )
-        
-        conn.commit()
-        conn.close()
+        invalidate_products_cache()
         
         return {"success": True, "message": "Produit mis à jour"}
     except HTTPException:
@@ -163,19 +372,24 @@ async def update_product(reference: str, product: ProductUpdate):
 async def delete_product(reference: str):
     """Supprimer un produit"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM products WHERE reference = ?", (reference,))
+        async with db_writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            
+            async with conn.execute(SQL_DELETE_PRODUCT, (reference,)) as cursor:
+                row = await cursor.fetchone()
+            
+            if row is None:
+                raise HTTPException(status_code=404, detail="Produit non trouvé")
+            
+            await conn.commit()
         
-        if cursor.rowcount == 0:
-            conn.close()
-            raise HTTPException(status_code=404, detail="Produit non trouvé")
+        invalidate_products_cache()
         
-        conn.commit()
-        conn.close()
-        
-        return {"success": True, "message": "Produit supprimé"}
+        return {
+            "success": True,
+            "message": "Produit supprimé",
+            "product": dict(zip(PRODUCT_COLUMNS, row))
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -185,60 +399,65 @@ async def delete_product(reference: str):
 # ENDPOINT BATCH - SYNCHRONISATION RAPIDE
 # ============================================================
 
-@app.post("/api/products/batch")
-async def batch_products(products: List[Product]):
+# Validation de la liste en un seul appel pydantic-core, directement sur le JSON brut
+PRODUCTS_ADAPTER = TypeAdapter(List[Product])
+
+@app.post(
+    "/api/products/batch",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": {"$ref": "#/components/schemas/Product"}}
+                }
+            }
+        }
+    }
+)
+async def batch_products(request: Request):
     """
     Synchronisation en masse de produits
     Crée les nouveaux produits et met à jour les existants
+    en une seule transaction (UPSERT multi-lignes par paquets de BATCH_ROWS_PER_STATEMENT)
     """
-    created = 0
-    updated = 0
-    failed = 0
-    errors = []
+    try:
+        products = PRODUCTS_ADAPTER.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        )
+    
+    rows = [
+        (product.reference, product.designation, product.price,
+         product.unit, product.family, product.icon)
+        for product in products
+    ]
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        for product in products:
-            try:
-                cursor.execute("SELECT reference FROM products WHERE reference = ?", (product.reference,))
-                exists = cursor.fetchone()
-                
-                if exists:
-                    cursor.execute(
-                        """UPDATE products 
-                           SET designation = ?, price = ?, unit = ?, family = ?, icon = ?, updated_at = ?
-                           WHERE reference = ?""",
-                        (product.designation, product.price, product.unit, product.family, 
-                         product.icon, datetime.now().isoformat(), product.reference)
-                    )
-                    updated += 1
-                else:
-                    cursor.execute(
-                        """INSERT INTO products (reference, designation, price, unit, family, icon)
-                           VALUES (?, ?, ?, ?, ?, ?)""",
-                        (product.reference, product.designation, product.price, 
-                         product.unit, product.family, product.icon)
-                    )
-                    created += 1
-                    
-            except Exception as e:
-                failed += 1
-                errors.append({
-                    "reference": product.reference,
-                    "error": str(e)
-                })
+        async with db_writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            
+            # Une seule requête pour distinguer créations et mises à jour
+            references = {product.reference for product in products}
+            async with conn.execute(SQL_EXISTING_REFERENCES, (orjson.dumps(list(references)).decode(),)) as cursor:
+                existing = {row[0] async for row in cursor}
+            created = len(references - existing)
+            
+            for i in range(0, len(rows), BATCH_ROWS_PER_STATEMENT):
+                chunk = rows[i:i + BATCH_ROWS_PER_STATEMENT]
+                await conn.execute(upsert_products_sql(len(chunk)), [value for row in chunk for value in row])
+            
+            await conn.commit()
         
-        conn.commit()
-        conn.close()
+        invalidate_products_cache()
         
         return {
             "success": True,
             "created": created,
-            "updated": updated,
-            "failed": failed,
-            "errors": errors,
+            "updated": len(products) - created,
+            "failed": 0,
+            "errors": [],
             "total": len(products)
         }
         
@@ -251,4 +470,15 @@ async def batch_products(products: List[Product]):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Boucle et parseur en "auto" : uvloop + httptools quand uvicorn[standard] les
+    # installe (pas uvloop sous Windows), asyncio + h11 sinon. Sans access log.
+    # Un seul worker par défaut ; en production, WORKERS=<nombre de cœurs> :
+    # WAL + busy_timeout + BEGIN IMMEDIATE permettent les écritures entre processus
+    uvicorn.run(
+        "backend_serveur:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WORKERS", "1")),
+        log_level="warning",
+        access_log=False,
+    )